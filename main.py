@@ -7,18 +7,42 @@ Joshua D. Scarsbrook - The University of Queensland
 Released under Apache 2.0 License
 """
 
-import argparse
+import functools
 import logging
+import re
 from typing import Tuple
-import asciinema
-import asciinema.asciicast
-import asciinema.player
 import os
-import uuid
-import json
-import platformdirs
-import datetime
+import pickle
+import secrets
+import shutil
 import subprocess
+import sys
+import time
+import types
+
+# Prefer a fast JSON implementation for registry I/O, falling back to the
+# stdlib when neither orjson nor ujson is installed.
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json
+
+    def json_loads(data):
+        return _json.loads(data)
+
+    def json_dumps(obj) -> bytes:
+        return _json.dumps(obj).encode()
+
 
 REGISTRY_VERSION = 1
 
@@ -38,13 +62,23 @@ def write_file(filename: str, content):
 
 
 def read_json(filename: str):
-    with open(filename, "r") as f:
-        return json.load(f)
+    with open(filename, "rb") as f:
+        return json_loads(f.read())
 
 
 def write_json(filename: str, obj):
-    with open(filename, "w") as f:
-        json.dump(obj, f)
+    with open(filename, "wb") as f:
+        f.write(json_dumps(obj))
+
+
+if os.sep == "/":
+    # Path components past the first are trusted relative names, so on
+    # POSIX a plain "/" join skips os.path.join's per-argument handling.
+    def joinpath(*parts: str) -> str:
+        return "/".join(parts)
+
+else:
+    joinpath = os.path.join
 
 
 def run_command(*args):
@@ -53,109 +87,181 @@ def run_command(*args):
     subprocess.check_call(args)
 
 
+@functools.cache
 def get_default_environment_path() -> str:
     """
     The default data directory is in the user config directory.
     """
 
+    # Imported lazily so invocations with an explicit --env skip it.
+    import platformdirs
+
     return platformdirs.user_data_dir("neurobuilder")
 
 
 def generate_container_id() -> str:
-    return str(uuid.uuid4())
+    return secrets.token_hex(16)
 
 
 def generate_version() -> str:
-    dt = datetime.datetime.now()
+    t = time.localtime()
+
+    return f"{t.tm_year:04d}{t.tm_mon:02d}{t.tm_mday:02d}_{t.tm_hour:02d}{t.tm_min:02d}"
 
-    return dt.strftime("%Y%m%d_%H%M")
+
+# Parsed registries cached per path, invalidated when the file's mtime
+# changes on disk.
+_REGISTRY_CACHE = {}
+
+
+def _write_registry_snapshot(registry_path, mtime, registry):
+    # Best effort: the snapshot is derived from the JSON, so failing to
+    # write it only costs the next run a parse.
+    try:
+        with open(registry_path + ".pkl", "wb") as f:
+            pickle.dump((mtime, registry), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+
+
+def _read_registry_snapshot(registry_path, mtime):
+    # Return the pickled snapshot from a previous run if it matches the
+    # current JSON mtime, else None. Unpickling is faster than parsing.
+    try:
+        with open(registry_path + ".pkl", "rb") as f:
+            snapshot_mtime, registry = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+
+    return registry if snapshot_mtime == mtime else None
 
 
 def load_registry(env):
-    registry_path = os.path.join(env, "registry.json")
+    registry_path = joinpath(env, "registry.json")
 
-    if not os.path.exists(registry_path):
-        os.makedirs(os.path.dirname(registry_path))
+    try:
+        mtime = os.stat(registry_path).st_mtime
+    except FileNotFoundError:
+        os.makedirs(env, exist_ok=True)
 
         return {
             "version": REGISTRY_VERSION,
             "containers": {},
         }
 
-    return read_json(registry_path)
+    cached = _REGISTRY_CACHE.get(registry_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    registry = _read_registry_snapshot(registry_path, mtime)
+    if registry is None:
+        registry = read_json(registry_path)
+        _write_registry_snapshot(registry_path, mtime, registry)
+
+    _REGISTRY_CACHE[registry_path] = (mtime, registry)
+
+    return registry
 
 
 def save_registry(env, registry):
-    registry_path = os.path.join(env, "registry.json")
+    registry_path = joinpath(env, "registry.json")
 
-    if not os.path.exists(registry_path):
-        os.makedirs(os.path.dirname(registry_path), exist_ok=True)
+    os.makedirs(env, exist_ok=True)
 
     write_json(registry_path, registry)
 
+    # Keep the in-memory cache and the on-disk snapshot in sync with what
+    # was just written.
+    mtime = os.stat(registry_path).st_mtime
+    _REGISTRY_CACHE[registry_path] = (mtime, registry)
+    _write_registry_snapshot(registry_path, mtime, registry)
 
-def get_container_path(env, name):
-    # Load the registry.
-    registry = load_registry(env)
 
-    # If the container path already exists then use that.
-    if name in registry["containers"]:
-        return registry["containers"][name]
+def lookup_container_path(registry, name):
+    # Look up the container in an already loaded registry.
+    if name not in registry["containers"]:
+        raise Exception(f"container {name} doesn't exist")
 
-    # Otherwise generate a new random container id.
-    container_id = generate_container_id()
+    return registry["containers"][name]
 
-    # Get the container path and create the directory.
-    container_path = os.path.join(env, container_id)
-    os.makedirs(container_path)
 
-    # Add the container to the registry and save it.
-    registry["containers"][name] = container_path
-    save_registry(env, registry)
+class Registry:
+    """
+    Context manager for registry updates. The registry is loaded once on
+    entry and written back on exit, and only if something changed, so any
+    number of updates inside the block cost a single write.
+    """
+
+    def __init__(self, env):
+        self.env = env
+        self.registry = None
+        self.dirty = False
+
+    def __enter__(self):
+        self.registry = load_registry(self.env)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.dirty and exc_type is None:
+            save_registry(self.env, self.registry)
+
+    def get_or_create(self, name):
+        # If the container path already exists then use that.
+        if name in self.registry["containers"]:
+            return self.registry["containers"][name]
+
+        # Otherwise generate a new random container id.
+        container_id = generate_container_id()
+
+        # Get the container path and create the directory.
+        container_path = joinpath(self.env, container_id)
+        os.makedirs(container_path)
 
-    return container_path
+        # Add the container to the registry and mark it for saving.
+        self.registry["containers"][name] = container_path
+        self.dirty = True
+
+        return container_path
 
 
 def get_container_version_path(container_path, version, mkdir=True) -> Tuple[str, bool]:
-    version_path = os.path.join(container_path, version)
+    version_path = joinpath(container_path, version)
 
-    if not os.path.exists(version_path):
-        if mkdir:
+    if mkdir:
+        try:
             os.mkdir(version_path)
-        return version_path, False
-    else:
-        return version_path, True
+            return version_path, False
+        except FileExistsError:
+            return version_path, True
 
+    return version_path, os.path.exists(version_path)
 
-def get_package_manager(base: str) -> str:
-    """
-    Attempt to autodetect the package manager.
-    """
 
-    if "ubuntu" in base:
-        return "apt"
-    elif "debian" in base:
-        return "apt"
-    elif "centos" in base:
-        return "yum"
-    elif "fedora" in base:
-        return "yum"
-    else:
-        return "unknown"
+# Known distributions and their package managers, matched in one regex scan.
+_PKG_MAP = {
+    "ubuntu": "apt",
+    "debian": "apt",
+    "centos": "yum",
+    "fedora": "yum",
+    "rocky": "yum",
+    "alma": "yum",
+}
 
+_PKG_RE = re.compile("|".join(_PKG_MAP), re.IGNORECASE)
 
-def get_template(package_manager: str, base: str) -> str:
+
+@functools.lru_cache(maxsize=64)
+def get_package_manager(base: str) -> str:
     """
-    Get the singularity build template.
+    Attempt to autodetect the package manager.
     """
 
-    template = ""
+    m = _PKG_RE.search(base)
 
-    # Bootstrap from docker.
-    template += "BootStrap: docker\n"
-    template += f"From: {base}\n"
+    return _PKG_MAP[m.group(0).lower()] if m else "unknown"
 
-    template += """%post -c /bin/bash
+
+_POST_HEADER = """%post -c /bin/bash
   set -ex
   touch /etc/localtime
   CUSTOM_ENV=/.singularity.d/env/99-zz_custom_env.sh
@@ -166,18 +272,28 @@ EOF
   chmod 755 $CUSTOM_ENV
 """
 
+_UBUNTU_MIRROR_SED = """sed -i -e 's|ports.ubuntu.com/ubuntu-ports|mirror.aarnet.edu.au/pub/ubuntu/ports|g' -e 's|archive.ubuntu.com/ubuntu|mirror.aarnet.edu.au/pub/ubuntu/archive|g' /etc/apt/sources.list
+"""
+
+
+def get_template(package_manager: str, base: str) -> str:
+    """
+    Get the singularity build template.
+    """
+
+    # Bootstrap from docker.
+    parts = ["BootStrap: docker\n", f"From: {base}\n", _POST_HEADER]
+
     # Change ubuntu repos to mirror.arrnet.edu.au
     if "ubuntu" in base:
-        template += """sed -i -e 's/ports.ubuntu.com\\/ubuntu-ports/mirror.aarnet.edu.au\\/pub\\/ubuntu\\/ports/g' /etc/apt/sources.list
-sed -i -e 's/archive.ubuntu.com\\/ubuntu/mirror.aarnet.edu.au\\/pub\\/ubuntu\\/archive/g' /etc/apt/sources.list
-"""
+        parts.append(_UBUNTU_MIRROR_SED)
 
     if package_manager == "apt":
-        template += "apt update -y\n"
+        parts.append("apt update -y\n")
     elif package_manager == "yum":
-        template += "yum update -y\n"
+        parts.append("yum update -y\n")
 
-    return template
+    return "".join(parts)
 
 
 def build_container_sandbox(
@@ -187,14 +303,14 @@ def build_container_sandbox(
     template = get_template(package_manager, base)
 
     # Make a new temporary directory.
-    temp_dir = os.path.join(env, "temp", str(uuid.uuid4()))
+    temp_dir = joinpath(env, "temp", secrets.token_hex(16))
     os.makedirs(temp_dir)
 
     # Create and write the template.
-    template_file = os.path.join(temp_dir, "template")
+    template_file = joinpath(temp_dir, "template")
     write_file(template_file, template)
 
-    sandbox_dir = os.path.join(temp_dir, "sandbox")
+    sandbox_dir = joinpath(temp_dir, "sandbox")
 
     # Run Singularity to create the build directory.
     run_command("sudo", "singularity", "build", "--sandbox", sandbox_dir, template_file)
@@ -207,17 +323,68 @@ def get_container_run_command(sandbox) -> str:
 
 
 def get_container_recording_path(version_path) -> str:
-    return os.path.join(version_path, "recording.cast")
+    return joinpath(version_path, "recording.cast")
+
+
+def sandbox_modified_since(sandbox_path, timestamp) -> bool:
+    """
+    Check whether anything inside the sandbox was modified after timestamp.
+    Returns at the first newer entry, so a touched sandbox is cheap to
+    detect and only a pristine one costs a full walk. Anything the walk
+    can't read is reported as modified: the sudo-built sandbox contains
+    root-owned 0700 directories we can't enter, and an edit inside them
+    doesn't bump any readable parent's mtime, so skipping them could
+    discard recorded work.
+    """
+
+    stack = [sandbox_path]
+
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.stat(follow_symlinks=False).st_mtime > timestamp:
+                            return True
+                    except OSError:
+                        return True
+
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        except OSError:
+            return True
+
+    return False
 
 
 def convert_container_to_sif(version_path, sandbox_path):
-    container_path = os.path.join(version_path, "container.sif")
+    container_path = joinpath(version_path, "container.sif")
 
     run_command("sudo", "singularity", "build", container_path, sandbox_path)
 
 
+def build_container_from_base(temp_dir, version_path, base):
+    # A bare docker:// build would skip the template's %post, and parts of
+    # it matter at runtime: /etc/localtime must exist for Singularity's
+    # bind to work on minimal images, and the custom env script sets up the
+    # shell. Replay those through a definition file; only the mirror and
+    # package index updates are safe to drop.
+    definition_file = joinpath(temp_dir, "base_template")
+    write_file(definition_file, f"BootStrap: docker\nFrom: {base}\n{_POST_HEADER}")
+
+    container_path = joinpath(version_path, "container.sif")
+
+    run_command("sudo", "singularity", "build", container_path, definition_file)
+
+
 def cleanup_temporary_path(temp_dir):
-    run_command("sudo", "rm", "-rf", temp_dir)
+    # Remove the directory in-process when we can. The sandbox may contain
+    # root-owned files from the singularity build, in which case fall back
+    # to removing it with sudo.
+    try:
+        shutil.rmtree(temp_dir)
+    except PermissionError:
+        run_command("sudo", "rm", "-rf", temp_dir)
 
 
 def cmd_create(args):
@@ -243,7 +410,8 @@ def cmd_create(args):
             raise Exception("could not autodetect package manager")
 
     # Get the container path or create it in the registry.
-    container_path = get_container_path(env, name)
+    with Registry(env) as reg:
+        container_path = reg.get_or_create(name)
 
     # Check that the version is unique
     version_path, exists = get_container_version_path(container_path, version)
@@ -265,11 +433,21 @@ def cmd_create(args):
     except:
         pass
 
-    # Actually run the container and do the recording.
+    # Actually run the container and do the recording. asciinema is
+    # imported lazily so commands that don't record start faster.
+    import asciinema
+
+    record_start = time.time()
     asciinema.record_asciicast(recording_path, command=record_command)
 
-    # Convert the container to sif format from the sandbox path.
-    convert_container_to_sif(version_path, sandbox)
+    if sandbox_modified_since(sandbox, record_start):
+        # Convert the container to sif format from the sandbox path.
+        convert_container_to_sif(version_path, sandbox)
+    else:
+        # The recorded session didn't touch the sandbox, so build the sif
+        # straight from the docker base and skip repacking the sandbox.
+        log.info("sandbox unchanged by recording, building from %s", base)
+        build_container_from_base(temp_dir, version_path, base)
 
     # Cleanup the sandbox path.
     cleanup_temporary_path(temp_dir)
@@ -284,16 +462,19 @@ def cmd_run(args):
     if env == "":
         env = get_default_environment_path()
 
-    # Get the container path.
-    container_path = get_container_path(env, name)
+    # Load the registry once and look up the container path.
+    registry = load_registry(env)
+    container_path = lookup_container_path(registry, name)
 
     # Get the container version path. It has to exist for this to work.
-    version_path, exists = get_container_version_path(container_path, version)
+    version_path, exists = get_container_version_path(
+        container_path, version, mkdir=False
+    )
     if not exists:
         raise Exception("that version doesn't exist")
 
     # Get the sif file.
-    sif_path = os.path.join(version_path, "container.sif")
+    sif_path = joinpath(version_path, "container.sif")
 
     # Finally run singularity with the sif file.
     run_command("singularity", "run", sif_path)
@@ -307,7 +488,31 @@ def cmd_run(args):
 #     raise NotImplementedError()
 
 
+def scan_container_versions(item):
+    # Collect the versions of one container that have a built sif file.
+    container, container_path = item
+
+    found = []
+
+    with os.scandir(container_path) as it:
+        for entry in it:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+
+            try:
+                os.stat(joinpath(entry.path, "container.sif"))
+            except FileNotFoundError:
+                continue
+
+            found.append((container, entry.name))
+
+    return found
+
+
 def cmd_list(args):
+    # Imported lazily so commands that don't list start faster.
+    from concurrent.futures import ThreadPoolExecutor
+
     env = args.env
 
     # Use the user supplied environment path
@@ -317,17 +522,23 @@ def cmd_list(args):
     # Load the registry.
     registry = load_registry(env)
 
-    # For each container get it's versions and print the name and the version.
-    for container in registry["containers"]:
-        container_path = registry["containers"][container]
+    containers = registry["containers"]
+    if not containers:
+        return
 
-        for child in os.listdir(container_path):
-            child_name = os.path.join(container_path, child, "container.sif")
-            if os.path.exists(child_name):
-                print(f"{container} {child}")
+    # Scan the containers in parallel since the work is I/O-bound, then
+    # print the results in registry order.
+    with ThreadPoolExecutor(max_workers=min(32, len(containers))) as ex:
+        for found in ex.map(scan_container_versions, containers.items()):
+            for container, version in found:
+                print(f"{container} {version}")
 
 
 def cmd_replay(args):
+    # Imported lazily so commands that don't replay start faster.
+    import asciinema.asciicast
+    import asciinema.player
+
     name = args.name
     version = args.version
     env = args.env
@@ -336,8 +547,9 @@ def cmd_replay(args):
     if env == "":
         env = get_default_environment_path()
 
-    # Get the container path.
-    container_path = get_container_path(env, name)
+    # Load the registry once and look up the container path.
+    registry = load_registry(env)
+    container_path = lookup_container_path(registry, name)
 
     # Get the container version path. It has to exist for this to work.
     version_path, exists = get_container_version_path(
@@ -355,7 +567,77 @@ def cmd_replay(args):
         player.play(a)
 
 
-if __name__ == "__main__":
+# The fast argv parser below handles these; anything else (help, typos,
+# abbreviated flags) falls back to argparse.
+_COMMANDS = {
+    # command: (handler, flags accepted after the command, positionals)
+    "create": (cmd_create, ("base", "pkg", "version"), ("name",)),
+    "run": (cmd_run, (), ("name", "version")),
+    "list": (cmd_list, (), ()),
+    "replay": (cmd_replay, (), ("name", "version")),
+}
+
+_FLAG_DEFAULTS = {"env": "", "base": "ubuntu:22.04", "pkg": "", "version": ""}
+
+
+def fast_parse(argv):
+    """
+    Parse the common invocations without constructing the argparse tree,
+    which dominates startup for a CLI this small. Returns an args object
+    with the same attributes argparse would produce, or None when the
+    command line needs argparse (--help, errors, unrecognized flags).
+    """
+
+    values = dict(_FLAG_DEFAULTS)
+    command = None
+    positionals = []
+
+    it = iter(argv)
+    for arg in it:
+        if arg.startswith("-"):
+            if not arg.startswith("--"):
+                return None
+
+            flag, sep, value = arg[2:].partition("=")
+
+            # --env is the only global flag; the rest belong to a command.
+            allowed = ("env",) if command is None else _COMMANDS[command][1]
+            if flag not in allowed:
+                return None
+
+            if not sep:
+                value = next(it, None)
+                # Like argparse, don't consume another flag as the value.
+                if value is None or value.startswith("-"):
+                    return None
+
+            values[flag] = value
+        elif command is None:
+            if arg not in _COMMANDS:
+                return None
+            command = arg
+        else:
+            positionals.append(arg)
+
+    if command is None:
+        return None
+
+    func, flags, names = _COMMANDS[command]
+    if len(positionals) != len(names):
+        return None
+
+    args = types.SimpleNamespace(func=func, env=values["env"])
+    for flag in flags:
+        setattr(args, flag, values[flag])
+    for name, value in zip(names, positionals):
+        setattr(args, name, value)
+
+    return args
+
+
+def build_parser():
+    import argparse
+
     parser = argparse.ArgumentParser(
         prog="neurobuilder", description="Build containers for neuroimaging software."
     )
@@ -440,5 +722,13 @@ if __name__ == "__main__":
     )
     parser_replay.set_defaults(func=cmd_replay)
 
-    args = parser.parse_args()
+    return parser
+
+
+if __name__ == "__main__":
+    args = fast_parse(sys.argv[1:])
+
+    if args is None:
+        args = build_parser().parse_args()
+
     args.func(args)